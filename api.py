@@ -21,9 +21,21 @@
 #
 # Copyright (C) 2011-2012, Pinterest, Inc. See LICENSE for details.
 
+import bisect
+import fnmatch
+import functools
+import heapq
+import itertools
+import os
 import pymysql
+import random
+import re
+import sqlite3
 import sys
 import socket
+import threading
+import time
+import zlib
 import simplejson as json
 
 # Configure these variables for database access. The user must have read access
@@ -35,14 +47,863 @@ MYSQL_PASSWD = "dashboard"
 MYSQL_DASHBOARD_DB = "dashboard"
 MYSQL_PUPPET_DB = "puppet"
 
+# Read-only MySQL replicas, as (host, port) pairs. Reads are spread across the
+# replicas that are reachable and no more than MYSQL_MAX_REPLICATION_LAG
+# seconds behind; writes always go to MYSQL_HOST. After a client writes, its
+# reads also go to MYSQL_HOST for MYSQL_READ_YOUR_WRITES_WINDOW seconds so
+# that it sees its own changes. Leave MYSQL_REPLICAS empty to send every query
+# to MYSQL_HOST. Replication lag is read with SHOW SLAVE STATUS, so on the
+# replicas the user also needs the REPLICATION CLIENT privilege; replicas that
+# can't be checked aren't used, and the error is written to stderr.
+MYSQL_REPLICAS = []
+MYSQL_MAX_REPLICATION_LAG = 30
+MYSQL_REPLICA_CHECK_INTERVAL = 10
+# Seconds to wait when connecting to a replica before giving up on it.
+MYSQL_REPLICA_CONNECT_TIMEOUT = 2
+MYSQL_READ_YOUR_WRITES_WINDOW = 60
+
+# Clients learn of their own writes from a last_write cookie. For clients that
+# don't keep cookies, set MYSQL_READ_YOUR_WRITES_BY_ADDRESS to also remember
+# writes by client address -- but only if clients don't share addresses (via
+# NAT, say), or one client's write sends them all to MYSQL_HOST. Requests from
+# the MYSQL_TRUSTED_PROXIES addresses are attributed to the first address in
+# their X-Forwarded-For header.
+MYSQL_READ_YOUR_WRITES_BY_ADDRESS = False
+MYSQL_TRUSTED_PROXIES = []
+
+# A snapshot of the dashboard and puppet data, written with
+# "python api.py snapshot <file>". When SNAPSHOT_FILE is set, each process
+# loads it at startup and serves reads from it whenever MySQL is unreachable,
+# adding an X-Snapshot-Age header (in seconds) to those responses. Only the
+# facts in SNAPSHOT_FACTS are copied into the snapshot.
+SNAPSHOT_FILE = None
+SNAPSHOT_FACTS = ['ec2_local_ipv4', 'ec2_public_ipv4']
+SNAPSHOT_RETRY_INTERVAL = 10
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024
+SNAPSHOT_VERSION = 1
+
 # This is the domain in which new hosts should reside. (For example, a host
 # called 'pluto001' would have the full domain name 'pluto001.example.com'.)
 MAIN_DOMAIN = "example.com"
 
-from flask import Flask, url_for, make_response, request
+# Number of rows /api/facts reads from MySQL at a time while streaming.
+FACTS_BATCH_SIZE = 1000
+
+# /api/enc serves every node's classification from an in-memory copy that is
+# rebuilt after ENC_REFRESH_INTERVAL seconds, or after this process writes.
+# A request for an unknown node rebuilds it if it is older than
+# ENC_MISS_REFRESH_INTERVAL seconds, so newly provisioned nodes show up.
+ENC_REFRESH_INTERVAL = 60
+ENC_MISS_REFRESH_INTERVAL = 5
+
+# Concurrent requests for the same node group or node class share a single
+# computation; its response is also reused for COALESCE_MICRO_CACHE seconds
+# afterwards (0 disables that).
+COALESCE_MICRO_CACHE = 1
+
+# Each request may run at most REQUEST_MAX_QUERIES queries and take at most
+# REQUEST_MAX_TIME seconds, after which it fails with a 503. SELECTs carry a
+# MAX_EXECUTION_TIME hint for the time the request has left (MySQL 5.7.8+),
+# except streamed ones (/api/facts): MySQL counts the time spent sending rows,
+# and a stream can't be turned into a 503 once it has started, so the time
+# limit only applies to streamed requests until their query is sent.
+REQUEST_MAX_QUERIES = 2000
+REQUEST_MAX_TIME = 10
+
+# /api/search answers from in-memory name indexes, which are updated by this
+# process's writes and reloaded after SEARCH_REFRESH_INTERVAL seconds.
+SEARCH_REFRESH_INTERVAL = 60
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+
+# Responses of at least GZIP_MIN_SIZE bytes are gzipped at GZIP_LEVEL for
+# clients that send "Accept-Encoding: gzip".
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+# Admission lanes, as (concurrent requests, queued requests, seconds a request
+# may wait in the queue). Node group and node class lookups expand whole
+# hierarchies, so they get their own lane and can't hold up the others, as do
+# streamed responses (/api/facts), which keep their slot, and a MySQL
+# connection, until the client has read the whole response.
+ADMISSION_LANES = {'read': (8, 64, 5),
+                   'heavy': (2, 16, 5),
+                   'stream': (4, 16, 5),
+                   'write': (2, 16, 10)}
+
+from flask import Flask, url_for, make_response, request, g
+from flask import has_request_context, Response
+from werkzeug.urls import url_quote
 app = Flask(__name__)
 
 
+# (host, port) -> (time of last check, whether the replica was usable)
+replica_health = {}
+# Held while a background round of replica checks is running.
+replica_check_lock = threading.Lock()
+# client address -> time of that client's last write, if
+# MYSQL_READ_YOUR_WRITES_BY_ADDRESS is set
+recent_writes = {}
+
+
+def check_replica(host, port):
+    """Returns True if the replica is reachable, replicating, and no more than
+    MYSQL_MAX_REPLICATION_LAG seconds behind the primary."""
+    cur = None
+    try:
+        conn = pymysql.connect(host=host, port=port, user=MYSQL_USER,
+                               passwd=MYSQL_PASSWD,
+                               connect_timeout=MYSQL_REPLICA_CONNECT_TIMEOUT)
+    except pymysql.err.MySQLError as e:
+        sys.stderr.write("Replica %s:%d unreachable: %s\n" % (host, port, e))
+        return False
+    try:
+        cur = conn.cursor(pymysql.cursors.DictCursor)
+        cur.execute("SHOW SLAVE STATUS")
+        r = cur.fetchone()
+        if r is None or r['Seconds_Behind_Master'] is None:
+            return False
+        return r['Seconds_Behind_Master'] <= MYSQL_MAX_REPLICATION_LAG
+    except pymysql.err.MySQLError as e:
+        sys.stderr.write("Replica %s:%d can't be checked: %s\n" %
+                         (host, port, e))
+        return False
+    finally:
+        if cur:
+            cur.close()
+        conn.close()
+
+
+def healthy_replicas():
+    """Returns the replicas that are currently usable for reads. Replicas whose
+    status is older than MYSQL_REPLICA_CHECK_INTERVAL seconds are rechecked in
+    the background, so requests never wait for a check; a replica isn't used
+    until it has been checked."""
+    now = time.time()
+    stale = [replica for replica in MYSQL_REPLICAS
+             if now - replica_health.get(replica, (0, False))[0] >
+             MYSQL_REPLICA_CHECK_INTERVAL]
+    if stale and replica_check_lock.acquire(False):
+        thread = threading.Thread(target=check_replicas, args=(stale,))
+        thread.daemon = True
+        thread.start()
+    return [replica for replica in MYSQL_REPLICAS
+            if replica_health.get(replica, (0, False))[1]]
+
+
+def check_replicas(replicas):
+    """Checks the given replicas in parallel and records the results. Called
+    with replica_check_lock held, which it releases when done."""
+    def check(replica):
+        replica_health[replica] = (time.time(), check_replica(*replica))
+
+    try:
+        threads = [threading.Thread(target=check, args=(replica,))
+                   for replica in replicas]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        replica_check_lock.release()
+
+
+def client_address():
+    """Returns the address of the client: the first address in X-Forwarded-For
+    for requests from MYSQL_TRUSTED_PROXIES, otherwise the peer's address."""
+    if request.remote_addr in MYSQL_TRUSTED_PROXIES:
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.remote_addr
+
+
+def wrote_recently():
+    """Returns True if the current client has written within the last
+    MYSQL_READ_YOUR_WRITES_WINDOW seconds, according to its last_write cookie
+    (or, with MYSQL_READ_YOUR_WRITES_BY_ADDRESS, its address)."""
+    if not has_request_context():
+        return False
+    if getattr(g, 'wrote', False):
+        return True
+    try:
+        last_write = float(request.cookies.get('last_write', 0))
+    except ValueError:
+        last_write = 0
+    if MYSQL_READ_YOUR_WRITES_BY_ADDRESS:
+        last_write = max(last_write, recent_writes.get(client_address(), 0))
+    return time.time() - last_write < MYSQL_READ_YOUR_WRITES_WINDOW
+
+
+def connect_mysql(db, write=False):
+    """Opens a connection to the given database. Writes, and reads made by a
+    client that has written recently, go to the primary (MYSQL_HOST); other
+    reads go to a randomly chosen healthy replica when there is one."""
+    if write:
+        if captured_queries is not None:
+            raise RuntimeError("Write attempted while collecting queries")
+        if has_request_context():
+            if MYSQL_READ_YOUR_WRITES_BY_ADDRESS:
+                now = time.time()
+                for client, last_write in list(recent_writes.items()):
+                    if now - last_write > MYSQL_READ_YOUR_WRITES_WINDOW:
+                        recent_writes.pop(client, None)
+                recent_writes[client_address()] = now
+            g.wrote = True
+    elif MYSQL_REPLICAS and not wrote_recently():
+        replicas = healthy_replicas()
+        if replicas:
+            replica = random.choice(replicas)
+            try:
+                return pymysql.connect(
+                    host=replica[0], port=replica[1], user=MYSQL_USER,
+                    passwd=MYSQL_PASSWD, db=db, cursorclass=BudgetedCursor,
+                    connect_timeout=MYSQL_REPLICA_CONNECT_TIMEOUT)
+            except pymysql.err.MySQLError:
+                replica_health[replica] = (time.time(), False)
+    return pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
+                           user=MYSQL_USER, passwd=MYSQL_PASSWD, db=db,
+                           cursorclass=BudgetedCursor)
+
+
+@app.after_request
+def compress_response(response):
+    """Gzips responses of at least GZIP_MIN_SIZE bytes for clients that accept
+    it, such as puppet_api_client.py. Streamed responses are left alone."""
+    if (response.status_code != 200 or response.direct_passthrough or
+            response.is_streamed or
+            'Content-Encoding' in response.headers or
+            'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.after_request
+def set_last_write_cookie(response):
+    """Tells the client when it last wrote, so that whichever API process
+    serves its next request can keep its reads on the primary."""
+    if getattr(g, 'wrote', False):
+        response.set_cookie('last_write', str(time.time()),
+                            max_age=MYSQL_READ_YOUR_WRITES_WINDOW)
+    return response
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class BudgetedCursor(pymysql.cursors.Cursor):
+    """A cursor that counts each query against the current request's budget
+    (see admit), and has MySQL stop any SELECT still running when the request
+    runs out of time (unless time_limit is False)."""
+
+    time_limit = True
+
+    def execute(self, query, args=None):
+        if captured_queries is not None:
+            captured_queries.append((self.connection.db, query))
+        remaining = charge_query()
+        if (self.time_limit and remaining is not None and
+                query.lstrip()[:6].upper() == "SELECT"):
+            query = "SELECT /*+ MAX_EXECUTION_TIME(%d) */%s" % (
+                max(1, int(remaining * 1000)), query.lstrip()[6:])
+        try:
+            return super(BudgetedCursor, self).execute(query, args)
+        except pymysql.err.OperationalError as e:
+            if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+                raise BudgetExceeded("Request took longer than %s seconds" %
+                                     REQUEST_MAX_TIME)
+            raise
+
+
+class BudgetedSSCursor(BudgetedCursor, pymysql.cursors.SSCursor):
+    """An unbuffered BudgetedCursor, for streaming large results. Its queries
+    aren't time limited, since MySQL would count the time spent streaming."""
+
+    time_limit = False
+
+
+# MySQL's error code for a query stopped by MAX_EXECUTION_TIME.
+ER_QUERY_TIMEOUT = 3024
+
+# While advise_schema() runs, every (database, query) executed is added here.
+captured_queries = None
+
+
+def charge_query():
+    """Counts a query against the current request's budget. Returns the
+    number of seconds the request has left, or None outside of a request."""
+    if not has_request_context() or not hasattr(g, 'deadline'):
+        return None
+    g.queries += 1
+    if g.queries > REQUEST_MAX_QUERIES:
+        raise BudgetExceeded("Request needed more than %d queries" %
+                             REQUEST_MAX_QUERIES)
+    remaining = g.deadline - time.time()
+    if remaining <= 0:
+        raise BudgetExceeded("Request took longer than %s seconds" %
+                             REQUEST_MAX_TIME)
+    return remaining
+
+
+def kill_query(conn):
+    """Asks MySQL to stop whatever query the given connection is running."""
+    if not isinstance(conn, pymysql.connections.Connection):
+        return
+    killer = pymysql.connect(host=conn.host, port=conn.port, user=MYSQL_USER,
+                             passwd=MYSQL_PASSWD)
+    cur = None
+    try:
+        cur = killer.cursor()
+        cur.execute("KILL QUERY %d" % conn.thread_id())
+    finally:
+        if cur:
+            cur.close()
+        killer.close()
+
+
+@app.errorhandler(BudgetExceeded)
+def budget_exceeded(error):
+    return str(error), 503
+
+
+class AdmissionLane(object):
+    """Lets at most `concurrency` requests run at once. Up to `max_waiting`
+    more may wait, each for at most `timeout` seconds, for a turn; the rest
+    are turned away."""
+
+    def __init__(self, concurrency, max_waiting, timeout):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        with self.condition:
+            if self.running < self.concurrency:
+                self.running += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                while self.running >= self.concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.running += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+
+admission_lanes = dict((name, AdmissionLane(*limits))
+                       for name, limits in ADMISSION_LANES.items())
+
+
+def admit(lane):
+    """Decorator that runs a view in the named admission lane and gives it a
+    budget of REQUEST_MAX_QUERIES queries and REQUEST_MAX_TIME seconds,
+    counted from when it is admitted. A streamed response keeps its place in
+    the lane until it has been sent (or the client has gone away)."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not admission_lanes[lane].acquire():
+                return "Server busy", 503
+            streaming = False
+            try:
+                g.queries = 0
+                g.deadline = time.time() + REQUEST_MAX_TIME
+                result = view(*args, **kwargs)
+                if isinstance(result, Response) and result.is_streamed:
+                    result.call_on_close(admission_lanes[lane].release)
+                    streaming = True
+                return result
+            finally:
+                if not streaming:
+                    admission_lanes[lane].release()
+        return wrapper
+    return decorator
+
+
+# Tables (and their columns) copied from each database into a snapshot.
+SNAPSHOT_TABLES = {
+    MYSQL_DASHBOARD_DB: [
+        ('nodes', ('id', 'name', 'status')),
+        ('node_groups', ('id', 'name')),
+        ('node_classes', ('id', 'name')),
+        ('node_group_edges', ('from_id', 'to_id')),
+        ('node_group_memberships', ('node_id', 'node_group_id')),
+        ('node_class_memberships', ('node_id', 'node_class_id')),
+        ('node_group_class_memberships', ('node_group_id', 'node_class_id')),
+        ('parameters', ('id', 'key', 'value', 'parameterable_type',
+                        'parameterable_id'))],
+    MYSQL_PUPPET_DB: [
+        ('hosts', ('id', 'name')),
+        ('fact_names', ('id', 'name')),
+        ('fact_values', ('host_id', 'fact_name_id', 'value', 'updated_at'))]}
+
+SNAPSHOT_INDEXES = [('nodes', ('name',)),
+                    ('node_groups', ('name',)),
+                    ('node_classes', ('name',)),
+                    ('node_group_edges', ('from_id',)),
+                    ('node_group_edges', ('to_id',)),
+                    ('node_group_memberships', ('node_id',)),
+                    ('node_group_memberships', ('node_group_id',)),
+                    ('node_class_memberships', ('node_id',)),
+                    ('node_class_memberships', ('node_class_id',)),
+                    ('node_group_class_memberships', ('node_group_id',)),
+                    ('node_group_class_memberships', ('node_class_id',)),
+                    ('parameters', ('parameterable_type',
+                                    'parameterable_id')),
+                    ('hosts', ('name',)),
+                    ('fact_names', ('name',)),
+                    ('fact_values', ('host_id', 'fact_name_id'))]
+
+# The snapshot loaded by load_snapshot(), and when it was taken.
+snapshot_file = None
+snapshot_connections = threading.local()
+# Until this time, reads go straight to the snapshot without trying MySQL.
+database_down_until = 0
+
+
+def write_snapshot(path):
+    """Copies the tables api.py reads (with only the SNAPSHOT_FACTS facts) from
+    MySQL into a new snapshot file at the given path. The snapshot is an SQLite
+    database whose user_version is SNAPSHOT_VERSION; it is written next to the
+    destination and renamed into place, so readers never see a partial file."""
+    tmp_path = "%s.tmp" % path
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    out = sqlite3.connect(tmp_path)
+    try:
+        out.execute("PRAGMA journal_mode = OFF")
+        out.execute("PRAGMA user_version = %d" % SNAPSHOT_VERSION)
+        out.execute("CREATE TABLE snapshot (created_at REAL)")
+        out.execute("INSERT INTO snapshot VALUES (?)", (time.time(),))
+        for db, tables in SNAPSHOT_TABLES.items():
+            conn = connect_mysql(db)
+            cur = None
+            try:
+                cur = conn.cursor(pymysql.cursors.SSCursor)
+                for table, columns in tables:
+                    names = ", ".join("`%s`" % c for c in columns)
+                    # MySQL compares these case-insensitively; so must SQLite
+                    # for ORDER BY name to sort the same way.
+                    out.execute("CREATE TABLE %s (%s)" % (table, ", ".join(
+                        "`%s` COLLATE NOCASE" % c
+                        if c in ('name', 'key', 'value') else "`%s`" % c
+                        for c in columns)))
+                    sql = "SELECT %s FROM %s" % (names, table)
+                    if table == 'fact_names':
+                        sql += " WHERE name IN (%s)" % ", ".join(
+                            conn.escape(f) for f in SNAPSHOT_FACTS)
+                    elif table == 'fact_values':
+                        sql = ("SELECT fv.host_id, fv.fact_name_id, fv.value, "
+                               "fv.updated_at FROM fact_values fv, "
+                               "fact_names fn WHERE fn.id = fv.fact_name_id "
+                               "AND fn.name IN (%s)" % ", ".join(
+                                   conn.escape(f) for f in SNAPSHOT_FACTS))
+                    cur.execute(sql)
+                    insert = "INSERT INTO %s VALUES (%s)" % (
+                        table, ", ".join("?" for c in columns))
+                    while True:
+                        rows = cur.fetchmany(1000)
+                        if not rows:
+                            break
+                        out.executemany(insert, [
+                            [v if v is None or isinstance(v, (int, long,
+                                                              float))
+                             else unicode(v) for v in r] for r in rows])
+            finally:
+                if cur:
+                    cur.close()
+                conn.close()
+        for table, columns in SNAPSHOT_INDEXES:
+            out.execute("CREATE INDEX %s_%s ON %s (%s)" % (
+                table, "_".join(columns), table,
+                ", ".join("`%s`" % c for c in columns)))
+        out.commit()
+    finally:
+        out.close()
+    os.rename(tmp_path, path)
+
+
+def load_snapshot(path):
+    """Makes the snapshot at the given path available for reads while MySQL is
+    unreachable. Raises ValueError if it was written by an incompatible
+    version of this script."""
+    global snapshot_file
+    db, created_at = open_snapshot(path)
+    db.close()
+    snapshot_file = path
+
+
+def open_snapshot(path):
+    """Opens the snapshot at the given path, returning the SQLite connection
+    and the time the snapshot was created. Raises ValueError if it was written
+    by an incompatible version of this script."""
+    db = sqlite3.connect(path)
+    try:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("%s is snapshot version %d, expected %d" %
+                             (path, version, SNAPSHOT_VERSION))
+        created_at = db.execute("SELECT created_at FROM snapshot").fetchone()
+        db.execute("PRAGMA query_only = 1")
+        db.execute("PRAGMA mmap_size = %d" % SNAPSHOT_MMAP_SIZE)
+    except:
+        db.close()
+        raise
+    return db, created_at[0]
+
+
+def warm_from_snapshot():
+    """Builds the Classification and name indexes from the loaded snapshot, so
+    that a freshly started process answers /api/enc and /api/search without
+    first reading every node from MySQL (and pages the snapshot in). Both are
+    marked as already expired: the first request that uses each rebuilds it
+    from MySQL, while concurrent ones are answered from the snapshot."""
+    global classification, name_indexes, name_indexes_built_at
+    global name_indexes_snapshot_created_at
+    classification = Classification(snapshot=True)
+    classification.built_at = 0
+    conn = SnapshotConnection()
+    name_indexes = build_name_indexes(conn)
+    name_indexes_built_at = 0
+    name_indexes_snapshot_created_at = conn.created_at
+
+
+class SnapshotConnection(object):
+    """A read-only stand-in for a pymysql connection that runs api.py's
+    queries against the loaded snapshot. Each thread keeps one memory-mapped
+    SQLite connection open; close() leaves it open for the next request. When
+    the snapshot file has been replaced (by renaming a new one over it), the
+    thread's connection is reopened on the new file, whose version is checked
+    again. created_at is the creation time of the snapshot being read."""
+
+    def __init__(self):
+        try:
+            # Taken before opening: if the file is replaced in between, the
+            # connection is merely reopened once more next time.
+            inode = os.stat(snapshot_file).st_ino
+            if getattr(snapshot_connections, 'inode', None) != inode:
+                if getattr(snapshot_connections, 'db', None):
+                    snapshot_connections.db.close()
+                    snapshot_connections.db = None
+                (snapshot_connections.db,
+                 snapshot_connections.created_at) = open_snapshot(
+                     snapshot_file)
+                snapshot_connections.inode = inode
+        except (OSError, ValueError, sqlite3.Error) as e:
+            snapshot_connections.inode = None
+            raise pymysql.err.OperationalError("Snapshot unavailable: %s" % e)
+        self.db = snapshot_connections.db
+        self.created_at = snapshot_connections.created_at
+
+    def cursor(self, cursorclass=None):
+        return self.db.cursor()
+
+    def escape(self, value):
+        if value is None:
+            return "NULL"
+        if isinstance(value, (int, long, float)):
+            return str(value)
+        return "'%s'" % value.replace("'", "''")
+
+    def commit(self):
+        raise pymysql.err.OperationalError("The snapshot is read-only")
+
+    def close(self):
+        pass
+
+
+def connect(db, write=False):
+    """Opens a connection to the given database (see connect_mysql). If MySQL
+    is unreachable and a snapshot is loaded, reads are served from the snapshot
+    instead, and MySQL is not tried again for SNAPSHOT_RETRY_INTERVAL
+    seconds."""
+    global database_down_until
+    if not write and snapshot_file and time.time() < database_down_until:
+        return connect_snapshot()
+    try:
+        return connect_mysql(db, write)
+    except pymysql.err.OperationalError:
+        if write or not snapshot_file:
+            raise
+        database_down_until = time.time() + SNAPSHOT_RETRY_INTERVAL
+        return connect_snapshot()
+
+
+def connect_snapshot():
+    conn = SnapshotConnection()
+    if has_request_context():
+        g.snapshot_created_at = conn.created_at
+    return conn
+
+
+@app.errorhandler(pymysql.err.OperationalError)
+def database_unavailable(error):
+    return "Database unavailable", 503
+
+
+@app.after_request
+def set_snapshot_age(response):
+    """Marks responses served from the snapshot with its age in seconds."""
+    created_at = getattr(g, 'snapshot_created_at', None)
+    if created_at is not None:
+        response.headers['X-Snapshot-Age'] = str(
+            int(time.time() - created_at))
+    return response
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time: callers that arrive while a
+    call for their key is in flight wait for it and share its result instead
+    of repeating the work. Results are kept for micro_cache seconds after the
+    call finishes, so callers arriving just afterwards share them too. Only
+    results for which shareable(result) is true are shared or kept; if the
+    call returns any other result, or raises, the waiting callers make their
+    own calls."""
+
+    def __init__(self, micro_cache=0, shareable=lambda result: True):
+        self.micro_cache = micro_cache
+        self.shareable = shareable
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.results = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            now = time.time()
+            cached = self.results.get(key)
+            if cached is not None and now - cached[0] <= self.micro_cache:
+                return cached[1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'event': threading.Event()}
+        if not leader:
+            call['event'].wait()
+            if not call['shared']:
+                return fn()
+            return call['result']
+        call['shared'] = False
+        try:
+            call['result'] = fn()
+            call['shared'] = self.shareable(call['result'])
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if call['shared'] and self.micro_cache:
+                    now = time.time()
+                    for k, (finished_at, _) in list(self.results.items()):
+                        if now - finished_at > self.micro_cache:
+                            del self.results[k]
+                    self.results[key] = (now, call['result'])
+            call['event'].set()
+        return call['result']
+
+
+# Only successful responses are shared: an error such as the leader being
+# turned away by its admission lane says nothing about the followers' chances.
+coalesced_requests = SingleFlight(COALESCE_MICRO_CACHE,
+                                  lambda result: result[1] == 200)
+
+
+def coalesce(view):
+    """Decorator for expensive GET views: concurrent requests for the same URL
+    share one run of the view (see SingleFlight) and its serialized response.
+    Clients that wrote recently bypass it so that they read their writes."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if wrote_recently():
+            return view(*args, **kwargs)
+
+        def run():
+            response = make_response(view(*args, **kwargs))
+            return (response.get_data(), response.status_code,
+                    list(response.headers.items()),
+                    getattr(g, 'snapshot_created_at', None))
+
+        body, status, headers, snapshot_created_at = coalesced_requests.do(
+            request.url, run)
+        if snapshot_created_at is not None:
+            g.snapshot_created_at = snapshot_created_at
+        return Response(body, status, headers)
+    return wrapper
+
+
+class LinkBuilder(object):
+    """Generates hypermedia links for a single request. Each endpoint is run
+    through url_for() once to build a template that names are filled into, and
+    finished links are memoized so a repeated source costs a dict lookup. When
+    links are disabled (?links=none), href() and source() return None."""
+
+    def __init__(self, host, enabled=True):
+        self.enabled = enabled
+        self.prefix = "https://" + host
+        self.templates = {}
+        self.hrefs = {}
+        self.sources = {}
+
+    def template(self, endpoint, keys):
+        key = (endpoint,) + keys
+        template = self.templates.get(key)
+        if template is None:
+            placeholders = dict((k, "LINKBUILDER%dLINKBUILDER" % i)
+                                for i, k in enumerate(keys))
+            template = (self.prefix +
+                        url_for(endpoint, **placeholders)).replace("%", "%%")
+            for k, placeholder in placeholders.items():
+                template = template.replace(placeholder, "%%(%s)s" % k)
+            self.templates[key] = template
+        return template
+
+    def href(self, endpoint, **values):
+        if not self.enabled:
+            return None
+        keys = tuple(sorted(values))
+        key = (endpoint,) + tuple(values[k] for k in keys)
+        href = self.hrefs.get(key)
+        if href is None:
+            quoted = dict((k, url_quote(v, safe='/:'))
+                          for k, v in values.items())
+            href = self.hrefs[key] = self.template(endpoint, keys) % quoted
+        return href
+
+    def link(self, type, name):
+        endpoint, arg = LINK_ENDPOINTS[type]
+        return self.href(endpoint, **{arg: name})
+
+    def source(self, type, name):
+        if not self.enabled:
+            return None
+        key = (type, name)
+        source = self.sources.get(key)
+        if source is None:
+            source = self.sources[key] = {'type': type, 'name': name,
+                                          'href': self.link(type, name)}
+        return source
+
+
+# Maps each record type to the endpoint (and its argument) that describes it.
+LINK_ENDPOINTS = {'node': ('get_node', 'node_name'),
+                  'node_group': ('get_node_group', 'node_group_name'),
+                  'node_class': ('get_node_class', 'node_class_name')}
+
+
+def get_links():
+    """Returns the LinkBuilder for the current request, creating it on first
+    use. Clients may pass ?links=none to omit href/url/source fields."""
+    links = getattr(g, 'links', None)
+    if links is None:
+        enabled = request.args.get('links', 'all').lower() != 'none'
+        links = g.links = LinkBuilder(request.host, enabled)
+    return links
+
+
+class Source(object):
+    """The node, node group or node class through which a record was found."""
+    __slots__ = ('type', 'name')
+
+    def __init__(self, type, name):
+        self.type = type
+        self.name = name
+
+
+class Record(object):
+    """A node, node group or node class returned by one of the helpers."""
+    __slots__ = ('id', 'name', 'type', 'source')
+
+    def __init__(self, id, name, type, source):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.source = source
+
+
+class Parameter(object):
+    """A node or node group parameter."""
+    __slots__ = ('id', 'key', 'value', 'source')
+
+    def __init__(self, id, key, value, source):
+        self.id = id
+        self.key = key
+        self.value = value
+        self.source = source
+
+
+class RecordTable(object):
+    """Interns names and Source objects for a single request, so that every
+    record reached through the same parent shares one Source and every
+    occurrence of a name shares one string."""
+
+    def __init__(self):
+        self.names = {}
+        self.sources = {}
+
+    def name(self, name):
+        return self.names.setdefault(name, name)
+
+    def source(self, type, name):
+        key = (type, name)
+        source = self.sources.get(key)
+        if source is None:
+            source = self.sources[key] = Source(type, self.name(name))
+        return source
+
+    def record(self, id, name, type, source):
+        return Record(id, self.name(name), type, source)
+
+
+def get_records():
+    """Returns the RecordTable for the current request."""
+    records = getattr(g, 'records', None)
+    if records is None:
+        records = g.records = RecordTable()
+    return records
+
+
+def serialize(obj):
+    """json.dumps() hook that turns model objects into dicts. Records are only
+    expanded here, as the response is written."""
+    links = get_links()
+    if isinstance(obj, Record):
+        result = {'id': obj.id, 'name': obj.name}
+        if links.enabled:
+            result['source'] = obj.source
+            result['href'] = links.link(obj.type, obj.name)
+        return result
+    if isinstance(obj, Parameter):
+        result = {'id': obj.id, 'key': obj.key, 'value': obj.value}
+        if links.enabled:
+            result['source'] = obj.source
+        return result
+    if isinstance(obj, Source):
+        return links.source(obj.type, obj.name)
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
 @app.route("/api/")
 def index():
     """API home page; lists other available endpoints in the API."""
@@ -61,36 +922,38 @@ def index():
 @app.route("/api/nodes/<status>")
 @app.route("/api/nodes")
 @app.route("/api/node")
+@admit('read')
 def list_nodes(status=None):
     """Lists all nodes defined in Puppet Dashboard."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_PUPPET_DB)
+    conn = connect(MYSQL_PUPPET_DB)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT h.name, fn.name, fv.value "
+        cur.execute("SELECT h.name, fn.name, fv.value, fv.updated_at "
                     "FROM hosts h, fact_names fn, fact_values fv "
                     "WHERE h.id = fv.host_id "
                     "AND fn.name in ('ec2_local_ipv4', 'ec2_public_ipv4') "
-                    "AND fn.id = fv.fact_name_id ORDER BY fv.updated_at")
+                    "AND fn.id = fv.fact_name_id")
+        # The most recently updated value of each fact wins. (This is done
+        # here rather than with ORDER BY, which would need a filesort.)
         node_facts = {}
+        updated = {}
         for r in cur.fetchall():
             name = r[0]
             if name not in node_facts:
                 node_facts[name] = {'ec2_local_ipv4': None,
                                     'ec2_public_ipv4': None}
             fact = r[1]
-            node_facts[name][fact] = r[2]
+            if (name, fact) not in updated or updated[name, fact] <= r[3]:
+                updated[name, fact] = r[3]
+                node_facts[name][fact] = r[2]
     finally:
         if cur:
             cur.close()
         conn.close()
 
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute("SELECT n.name, p.`value` FROM parameters p, nodes n "
@@ -107,22 +970,21 @@ def list_nodes(status=None):
         conn.close()
 
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         if status:
             cur.execute("SELECT id, name FROM nodes WHERE status = %s "
-                        "ORDER BY UPPER(name)" % conn.escape(status))
+                        "ORDER BY name" % conn.escape(status))
         else:
-            cur.execute("SELECT id, name FROM nodes ORDER BY UPPER(name)")
+            cur.execute("SELECT id, name FROM nodes ORDER BY name")
+        links = get_links()
         data = []
         for r in cur.fetchall():
             name = r[1]
-            url = "https://%s%s" % (request.host, url_for(
-                                    'get_node', node_name=name))
-            rec = {"name": name, "url": url}
+            rec = {"name": name}
+            if links.enabled:
+                rec['url'] = links.href('get_node', node_name=name)
             if name in node_facts:
                 rec['ec2_local_ipv4'] = node_facts[name]['ec2_local_ipv4']
                 rec['ec2_public_ipv4'] = node_facts[name]['ec2_public_ipv4']
@@ -139,15 +1001,14 @@ def list_nodes(status=None):
 
 
 @app.route("/api/node/<node_name>", methods=['GET'])
+@admit('read')
 def get_node(node_name):
     """Returns detailed information about the specified node."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, status FROM nodes WHERE name = '%s' LIMIT 1" %
+        cur.execute("SELECT id, status FROM nodes WHERE name = %s LIMIT 1" %
                     conn.escape(node_name))
         data = {}
         r = cur.fetchone()
@@ -166,46 +1027,47 @@ def get_node(node_name):
     data['facts'] = []
     for node_group in data['node_groups']:
         data['node_classes'].extend(
-            get_classes_for_group(node_group['id'], node_group['name']))
+            get_classes_for_group(node_group.id, node_group.name))
 
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_PUPPET_DB)
+    conn = connect(MYSQL_PUPPET_DB)
     try:
         cur = conn.cursor()
         cur.execute("SELECT n.name, v.value "
                     "FROM hosts h, fact_names n, fact_values v "
                     "WHERE h.id = v.host_id AND n.id = v.fact_name_id "
-                    "AND h.name = '%s'" % conn.escape(node_name))
+                    "AND h.name = %s" % conn.escape(node_name))
+        links = get_links()
         for r in cur.fetchall():
-            url = "https://" + request.host + url_for(
-                'get_node_fact', node_name=node_name, fact_name=r[0])
-            data['facts'].append({"name": r[0], "url": url, "value": r[1]})
+            fact = {"name": r[0], "value": r[1]}
+            if links.enabled:
+                fact['url'] = links.href('get_node_fact', node_name=node_name,
+                                         fact_name=r[0])
+            data['facts'].append(fact)
     finally:
         if cur:
             cur.close()
         conn.close()
-    response = make_response(json.dumps(data, indent=2))
+    response = make_response(json.dumps(data, indent=2,
+                                        default=serialize))
     response.headers['Content-Type'] = 'application/json'
     return response
 
 
 @app.route("/api/node/<node_name>/fact/<fact_name>",
            methods=['PUT', 'GET', 'DELETE'])
+@admit('read')
 def get_node_fact(node_name, fact_name):
     """Returns the value of the specified node fact."""
     if request.method == 'PUT' or request.method == 'DELETE':
         return "This method is deprecated", 200
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_PUPPET_DB)
+    conn = connect(MYSQL_PUPPET_DB)
     try:
         cur = conn.cursor()
         cur.execute("SELECT v.value FROM hosts h, fact_names n, fact_values v "
                     "WHERE h.id = v.host_id AND n.id = v.fact_name_id "
-                    "AND h.name = '%s' AND n.name = '%s' LIMIT 1" %
+                    "AND h.name = %s AND n.name = %s LIMIT 1" %
                     (conn.escape(node_name), conn.escape(fact_name)))
         r = cur.fetchone()
         if r is None:
@@ -220,7 +1082,584 @@ def get_node_fact(node_name, fact_name):
     return response
 
 
+@app.route("/api/facts", methods=['GET', 'POST'])
+@admit('stream')
+def get_facts():
+    """Returns the given facts for the given nodes as a node x fact matrix,
+    {node: {fact: value}}, using a single query. Nodes and facts are passed as
+    comma-separated (or repeated) "nodes" and "facts" arguments, either in the
+    query string or, for long lists, in a POSTed form. If no facts are given,
+    every fact is returned. Node and fact names match case-insensitively, as
+    MySQL compares them; nodes are returned as stored and facts as requested.
+    Where a fact has several values, the most recently updated one wins, as
+    in list_nodes. The result is streamed one node at a time, and isn't cut
+    off by REQUEST_MAX_TIME once it has started."""
+    node_names = get_list_arg('nodes')
+    fact_names = get_list_arg('facts')
+    if not node_names:
+        return "No nodes specified", 400
+    cur = None
+    conn = connect(MYSQL_PUPPET_DB)
+    try:
+        sql = ("SELECT h.name, n.name, v.value "
+               "FROM hosts h, fact_names n, fact_values v "
+               "WHERE h.id = v.host_id AND n.id = v.fact_name_id "
+               "AND h.name IN (%s)" %
+               ", ".join(conn.escape(name) for name in node_names))
+        if fact_names:
+            sql += " AND n.name IN (%s)" % ", ".join(
+                conn.escape(name) for name in fact_names)
+        sql += " ORDER BY h.name, v.updated_at"
+        cur = conn.cursor(BudgetedSSCursor)
+        cur.execute(sql)
+    except:
+        if cur:
+            cur.close()
+        conn.close()
+        raise
+
+    def fetch_rows():
+        while True:
+            rows = cur.fetchmany(FACTS_BATCH_SIZE)
+            if not rows:
+                break
+            for r in rows:
+                yield r
+
+    requested = dict((name.lower(), name) for name in fact_names)
+
+    def format_node(node_name, values):
+        row = {}
+        for r in values:
+            row[requested.get(r[1].lower(), r[1])] = r[2]
+        for name in fact_names:
+            row.setdefault(name, None)
+        return "%s: %s" % (json.dumps(node_name),
+                           json.dumps(row, sort_keys=True))
+
+    def generate():
+        finished = False
+        try:
+            separator = "{\n"
+            found = set()
+            for node_name, values in itertools.groupby(fetch_rows(),
+                                                       lambda r: r[0]):
+                found.add(node_name.lower())
+                yield separator + format_node(node_name, values)
+                separator = ",\n"
+            for node_name in node_names:
+                if node_name.lower() not in found:
+                    yield separator + format_node(node_name, [])
+                    separator = ",\n"
+            yield "\n}\n"
+            finished = True
+        finally:
+            if finished:
+                cur.close()
+            else:
+                # The client disconnected (or something failed) part way
+                # through; stop the query instead of reading out the rest.
+                try:
+                    kill_query(conn)
+                except pymysql.err.MySQLError:
+                    pass
+            conn.close()
+
+    return Response(generate(), mimetype='application/json')
+
+
+def get_list_arg(name):
+    """Returns the distinct values of a list argument, which may be repeated
+    and/or comma-separated, from the query string and form body."""
+    result = []
+    seen = set()
+    for value in (request.args.getlist(name) + request.form.getlist(name)):
+        for item in value.split(","):
+            item = item.strip()
+            if item and item not in seen:
+                seen.add(item)
+                result.append(item)
+    return result
+
+
+@app.route("/api/stats")
+@coalesce
+@admit('heavy')
+def get_stats():
+    """Returns fleet-wide counts: nodes by status, nodes per node group and
+    per node class, and how many hosts report EC2 IP facts. Node group counts
+    include the nodes of descendant groups, and node class counts include the
+    nodes of every group (or descendant group) the class is assigned to,
+    matching get_node_group and get_node_class; each node is counted once."""
+    rows = {}
+    cur = None
+    conn = connect(MYSQL_DASHBOARD_DB)
+    try:
+        cur = conn.cursor()
+        for table, sql in STATS_QUERIES:
+            cur.execute(sql)
+            rows[table] = cur.fetchall()
+    finally:
+        if cur:
+            cur.close()
+        conn.close()
+
+    parents = {}
+    for r in rows['node_group_edges']:
+        parents.setdefault(r[0], []).append(r[1])
+    node_groups = {}
+    for r in rows['node_group_memberships']:
+        node_groups.setdefault(r[0], []).append(r[1])
+    node_classes = {}
+    for r in rows['node_class_memberships']:
+        node_classes.setdefault(r[0], set()).add(r[1])
+    group_classes = {}
+    for r in rows['node_group_class_memberships']:
+        group_classes.setdefault(r[0], []).append(r[1])
+
+    closures = {}
+
+    def group_closure(group_id, path):
+        """Returns the group and all of its ancestors."""
+        if group_id in path:
+            return frozenset()
+        closure = closures.get(group_id)
+        if closure is None:
+            closure = set([group_id])
+            for parent_id in parents.get(group_id, []):
+                closure |= group_closure(parent_id, path + (group_id,))
+            closure = closures[group_id] = frozenset(closure)
+        return closure
+
+    group_counts = dict((r[0], 0) for r in rows['node_groups'])
+    class_counts = dict((r[0], 0) for r in rows['node_classes'])
+    for node_id in set(node_groups) | set(node_classes):
+        groups = set()
+        for group_id in node_groups.get(node_id, []):
+            groups |= group_closure(group_id, ())
+        classes = set(node_classes.get(node_id, ()))
+        for group_id in groups:
+            group_counts[group_id] = group_counts.get(group_id, 0) + 1
+            classes.update(group_classes.get(group_id, []))
+        for class_id in classes:
+            class_counts[class_id] = class_counts.get(class_id, 0) + 1
+
+    group_names = dict(rows['node_groups'])
+    class_names = dict(rows['node_classes'])
+    by_status = dict(rows['nodes'])
+    data = {'nodes': {'total': sum(by_status.values()),
+                      'by_status': by_status},
+            'node_groups': dict((group_names[k], v)
+                                for k, v in group_counts.items()
+                                if k in group_names),
+            'node_classes': dict((class_names[k], v)
+                                 for k, v in class_counts.items()
+                                 if k in class_names)}
+
+    cur = None
+    conn = connect(MYSQL_PUPPET_DB)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM hosts")
+        facts = {'hosts': cur.fetchone()[0],
+                 'ec2_local_ipv4': 0, 'ec2_public_ipv4': 0}
+        cur.execute("SELECT fn.name, COUNT(DISTINCT fv.host_id) "
+                    "FROM fact_names fn, fact_values fv "
+                    "WHERE fn.name in ('ec2_local_ipv4', 'ec2_public_ipv4') "
+                    "AND fn.id = fv.fact_name_id GROUP BY fn.name")
+        for r in cur.fetchall():
+            facts[r[0]] = r[1]
+        data['facts'] = facts
+    finally:
+        if cur:
+            cur.close()
+        conn.close()
+    response = make_response(json.dumps(data, indent=2, sort_keys=True))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+STATS_QUERIES = [
+    ('nodes', "SELECT status, COUNT(*) FROM nodes GROUP BY status"),
+    ('node_groups', "SELECT id, name FROM node_groups"),
+    ('node_classes', "SELECT id, name FROM node_classes"),
+    ('node_group_edges', "SELECT from_id, to_id FROM node_group_edges"),
+    # Memberships of deleted nodes are left behind by delete_node; joining
+    # nodes skips them, as get_nodes_for_group and get_nodes_for_class do.
+    ('node_group_memberships',
+     "SELECT DISTINCT m.node_id, m.node_group_id "
+     "FROM node_group_memberships m, nodes n WHERE n.id = m.node_id"),
+    ('node_class_memberships',
+     "SELECT DISTINCT m.node_id, m.node_class_id "
+     "FROM node_class_memberships m, nodes n WHERE n.id = m.node_id"),
+    ('node_group_class_memberships',
+     "SELECT DISTINCT node_group_id, node_class_id "
+     "FROM node_group_class_memberships")]
+
+
+@app.route("/api/search")
+@admit('read')
+def search():
+    """Finds nodes, node groups and node classes by name, case-insensitively.
+    Pass either prefix=<text> or glob=<pattern> (with *, ? and [...]), and
+    optionally type=node, node_group or node_class. Results are ordered by
+    name and paginated with offset= and limit= (at most SEARCH_MAX_LIMIT);
+    "next_offset" is included when there are more."""
+    prefix = request.args.get('prefix')
+    pattern = request.args.get('glob')
+    if (prefix is None) == (pattern is None):
+        return "Specify either prefix or glob", 400
+    types = request.args.getlist('type') or sorted(SEARCH_TABLES)
+    if any(type not in SEARCH_TABLES for type in types):
+        return "Unknown type", 400
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = min(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)),
+                    SEARCH_MAX_LIMIT)
+    except ValueError:
+        return "offset and limit must be integers", 400
+    if offset < 0 or limit < 1:
+        return "offset and limit must be positive", 400
+
+    indexes = get_name_indexes()
+    # No type can contribute more than offset + limit + 1 names to the page.
+    wanted = offset + limit + 1
+    if name_indexes_snapshot_created_at is not None:
+        g.snapshot_created_at = name_indexes_snapshot_created_at
+    matches = []
+    for type in types:
+        if prefix is not None:
+            names = indexes[type].prefix(prefix, wanted)
+        else:
+            names = indexes[type].glob(pattern, wanted)
+        matches.append([(name.lower(), type, name) for name in names])
+    page = list(itertools.islice(heapq.merge(*matches), offset,
+                                 offset + limit + 1))
+    links = get_links()
+    results = []
+    for key, type, name in page[:limit]:
+        result = {'type': type, 'name': name}
+        if links.enabled:
+            result['href'] = links.link(type, name)
+        results.append(result)
+    data = {'results': results, 'offset': offset, 'limit': limit}
+    if len(page) > limit:
+        data['next_offset'] = offset + limit
+    response = make_response(json.dumps(data, indent=2))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+class NameIndex(object):
+    """A case-insensitively sorted list of names, searched by binary search.
+    Names are kept in parallel lists of lowercased keys and original names."""
+
+    def __init__(self, names):
+        entries = sorted((name.lower(), name) for name in names)
+        self.keys = [entry[0] for entry in entries]
+        self.names = [entry[1] for entry in entries]
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            key = name.lower()
+            i = bisect.bisect_left(self.keys, key)
+            while i < len(self.keys) and self.keys[i] == key:
+                if self.names[i] == name:
+                    return
+                i += 1
+            self.keys.insert(i, key)
+            self.names.insert(i, name)
+
+    def remove(self, name):
+        with self.lock:
+            key = name.lower()
+            i = bisect.bisect_left(self.keys, key)
+            while i < len(self.keys) and self.keys[i] == key:
+                if self.names[i] == name:
+                    del self.keys[i]
+                    del self.names[i]
+                    return
+                i += 1
+
+    def range(self, prefix):
+        """Returns the (start, end) positions of the names with the given
+        (lowercase) prefix."""
+        return (bisect.bisect_left(self.keys, prefix),
+                bisect.bisect_left(self.keys, prefix + u"\uffff"))
+
+    def prefix(self, prefix, limit):
+        """Returns the first `limit` names with the given prefix."""
+        with self.lock:
+            start, end = self.range(prefix.lower())
+            return self.names[start:min(end, start + limit)]
+
+    def glob(self, pattern, limit):
+        """Returns the first `limit` names matching a shell-style pattern. Only
+        the names sharing the pattern's literal prefix are tested against it,
+        and only until enough have matched."""
+        pattern = pattern.lower()
+        literal = re.match(r"[^*?\[]*", pattern).group(0)
+        with self.lock:
+            start, end = self.range(literal)
+            return list(itertools.islice(
+                (self.names[i] for i in xrange(start, end)
+                 if fnmatch.fnmatchcase(self.keys[i], pattern)), limit))
+
+
+SEARCH_TABLES = {'node': 'nodes',
+                 'node_group': 'node_groups',
+                 'node_class': 'node_classes'}
+
+name_indexes = None
+name_indexes_built_at = 0
+# The creation time of the snapshot the name indexes were built from, if any.
+name_indexes_snapshot_created_at = None
+name_indexes_lock = threading.Lock()
+
+
+def get_name_indexes():
+    """Returns a NameIndex for each of SEARCH_TABLES, rebuilding them once
+    they are older than SEARCH_REFRESH_INTERVAL seconds (to pick up changes
+    made elsewhere). While one thread rebuilds, the others keep using the
+    previous ones."""
+    global name_indexes, name_indexes_built_at
+    global name_indexes_snapshot_created_at
+    current = name_indexes
+    if (current is not None and
+            time.time() - name_indexes_built_at <= SEARCH_REFRESH_INTERVAL):
+        return current
+    if not name_indexes_lock.acquire(current is None):
+        return current
+    try:
+        if (name_indexes is None or time.time() - name_indexes_built_at >
+                SEARCH_REFRESH_INTERVAL):
+            built_at = time.time()
+            conn = connect(MYSQL_DASHBOARD_DB)
+            indexes = build_name_indexes(conn)
+            name_indexes = indexes
+            name_indexes_built_at = built_at
+            name_indexes_snapshot_created_at = getattr(conn, 'created_at',
+                                                       None)
+        return name_indexes
+    finally:
+        name_indexes_lock.release()
+
+
+def build_name_indexes(conn):
+    """Returns a NameIndex for each of SEARCH_TABLES, read through the given
+    connection, which is then closed."""
+    indexes = {}
+    cur = None
+    try:
+        cur = conn.cursor()
+        for type, table in SEARCH_TABLES.items():
+            cur.execute("SELECT name FROM %s" % table)
+            indexes[type] = NameIndex(r[0] for r in cur.fetchall())
+    finally:
+        if cur:
+            cur.close()
+        conn.close()
+    return indexes
+
+
+def index_name(type, name, remove=False):
+    """Adds a name to (or removes it from) the loaded name index of the given
+    type, so this process's own writes show up in searches immediately."""
+    indexes = name_indexes
+    if indexes is None:
+        return
+    if remove:
+        indexes[type].remove(name)
+    else:
+        indexes[type].add(name)
+
+
+@app.route("/api/enc/<node_name>")
+@admit('read')
+def get_node_enc(node_name):
+    """Returns the Puppet External Node Classifier (ENC) YAML document for the
+    specified node: its classes and parameters, including those it inherits
+    from its node groups. Served from a precomputed Classification."""
+    classification = get_classification()
+    document = classification.documents.get(node_name.lower())
+    if document is None:
+        classification = get_classification(ENC_MISS_REFRESH_INTERVAL)
+        document = classification.documents.get(node_name.lower())
+    if classification.snapshot_created_at is not None:
+        g.snapshot_created_at = classification.snapshot_created_at
+    if document is None:
+        return "Node not found", 404
+    response = make_response(document)
+    response.headers['Content-Type'] = 'text/yaml'
+    return response
+
+
+class Classification(object):
+    """The ENC document of every node, built from one query per table rather
+    than the per-node helper chain that get_node uses. Classes and parameters
+    are resolved the same way get_node resolves them: a node's own classes
+    come first, followed by those of its node groups and their ancestors, and
+    its own parameters override those of its groups. Memberships of classes
+    that no longer exist are skipped, as get_node's joins skip them. Built
+    from the loaded snapshot if snapshot is True."""
+
+    def __init__(self, snapshot=False):
+        self.built_at = time.time()
+        rows = {}
+        cur = None
+        if snapshot:
+            conn = SnapshotConnection()
+        else:
+            conn = connect(MYSQL_DASHBOARD_DB)
+        self.snapshot_created_at = getattr(conn, 'created_at', None)
+        try:
+            cur = conn.cursor()
+            for table, sql in ENC_QUERIES:
+                cur.execute(sql)
+                rows[table] = cur.fetchall()
+        finally:
+            if cur:
+                cur.close()
+            conn.close()
+
+        class_names = dict(rows['node_classes'])
+        self.parents = {}
+        for r in rows['node_group_edges']:
+            self.parents.setdefault(r[0], []).append(r[1])
+        node_groups = {}
+        for r in rows['node_group_memberships']:
+            node_groups.setdefault(r[0], []).append(r[1])
+        node_classes = {}
+        for r in rows['node_class_memberships']:
+            if r[1] in class_names:
+                node_classes.setdefault(r[0], []).append(class_names[r[1]])
+        self.group_classes = {}
+        for r in rows['node_group_class_memberships']:
+            if r[1] in class_names:
+                self.group_classes.setdefault(r[0], []).append(
+                    class_names[r[1]])
+        node_params = {}
+        self.group_params = {}
+        for r in rows['parameters']:
+            if r[0] == "Node":
+                node_params.setdefault(r[1], {})[r[2]] = r[3]
+            else:
+                self.group_params.setdefault(r[1], {})[r[2]] = r[3]
+        self.resolved_params = {}
+
+        # Keyed by lowercased name: MySQL, and so get_node, ignores case.
+        self.documents = {}
+        for node_id, node_name in rows['nodes']:
+            classes = list(node_classes.get(node_id, []))
+            params = dict(node_params.get(node_id, {}))
+            for group_id in node_groups.get(node_id, []):
+                for key, value in self.parameters_for_group(
+                        group_id, ()).items():
+                    params.setdefault(key, value)
+                for ancestor_id in self.groups_with_ancestors(group_id, ()):
+                    classes.extend(self.group_classes.get(ancestor_id, []))
+            self.documents[node_name.lower()] = format_enc(classes, params)
+
+    def groups_with_ancestors(self, group_id, path):
+        if group_id in path:
+            return []
+        result = [group_id]
+        for parent_id in self.parents.get(group_id, []):
+            result.extend(self.groups_with_ancestors(parent_id,
+                                                     path + (group_id,)))
+        return result
+
+    def parameters_for_group(self, group_id, path):
+        """Returns the group's own parameters, plus its ancestors' for keys it
+        doesn't set."""
+        if group_id in path:
+            return {}
+        params = self.resolved_params.get(group_id)
+        if params is None:
+            params = dict(self.group_params.get(group_id, {}))
+            for parent_id in self.parents.get(group_id, []):
+                for key, value in self.parameters_for_group(
+                        parent_id, path + (group_id,)).items():
+                    params.setdefault(key, value)
+            self.resolved_params[group_id] = params
+        return params
+
+
+ENC_QUERIES = [
+    ('nodes', "SELECT id, name FROM nodes"),
+    ('node_classes', "SELECT id, name FROM node_classes"),
+    ('node_group_edges', "SELECT from_id, to_id FROM node_group_edges"),
+    ('node_group_memberships',
+     "SELECT node_id, node_group_id FROM node_group_memberships"),
+    ('node_class_memberships',
+     "SELECT node_id, node_class_id FROM node_class_memberships"),
+    ('node_group_class_memberships',
+     "SELECT node_group_id, node_class_id FROM node_group_class_memberships"),
+    # Uses the same parameterable_type values as get_parameters_for_node and
+    # get_parameters_for_group.
+    ('parameters',
+     "SELECT parameterable_type, parameterable_id, `key`, `value` "
+     "FROM parameters WHERE parameterable_type IN ('Node', 'get_node_group') "
+     "ORDER BY `key`, `value`")]
+
+classification = None
+classification_expired = False
+classification_lock = threading.Lock()
+
+
+def get_classification(max_age=None):
+    """Returns the current Classification, rebuilding it if it is older than
+    max_age (default ENC_REFRESH_INTERVAL) seconds or a write has expired it.
+    While one thread rebuilds, the others keep using the previous one."""
+    global classification, classification_expired
+    if max_age is None:
+        max_age = ENC_REFRESH_INTERVAL
+    current = classification
+    if (current is not None and not classification_expired and
+            time.time() - current.built_at <= max_age):
+        return current
+    if not classification_lock.acquire(current is None):
+        return current
+    try:
+        if (classification is None or classification_expired or
+                time.time() - classification.built_at > max_age):
+            classification_expired = False
+            classification = Classification()
+        return classification
+    finally:
+        classification_lock.release()
+
+
+def expire_classification():
+    """Makes the next ENC request rebuild the Classification."""
+    global classification_expired
+    classification_expired = True
+
+
+def format_enc(classes, parameters):
+    """Renders an ENC YAML document. Scalars are written as JSON strings,
+    which are valid YAML double-quoted scalars."""
+    lines = ["---"]
+    seen = set()
+    classes = [c for c in classes if not (c in seen or seen.add(c))]
+    if classes:
+        lines.append("classes:")
+        lines.extend("  - %s" % json.dumps(c) for c in classes)
+    else:
+        lines.append("classes: []")
+    if parameters:
+        lines.append("parameters:")
+        lines.extend("  %s: %s" % (json.dumps(key),
+                                   json.dumps(parameters[key]))
+                     for key in sorted(parameters))
+    else:
+        lines.append("parameters: {}")
+    return "\n".join(lines) + "\n"
+
+
 @app.route("/api/provision/<node_group_name>")
+@admit('write')
 def provision_node(node_group_name):
     """Creates a new node in the specified node group, and returns the
     hostname."""
@@ -239,15 +1678,14 @@ def provision_node(node_group_name):
 
 
 @app.route("/api/node/<node_name>", methods=['DELETE'])
+@admit('write')
 def delete_node(node_name):
     """Deletes the specified node from Puppet Dashboard's database."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB, write=True)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id FROM nodes WHERE name = '%s' LIMIT 1" %
+        cur.execute("SELECT id FROM nodes WHERE name = %s LIMIT 1" %
                     conn.escape(node_name))
         r = cur.fetchone()
         if r is None:
@@ -267,6 +1705,8 @@ def delete_node(node_name):
         cur.close()
         cur = None
         conn.commit()
+        expire_classification()
+        index_name('node', node_name, remove=True)
     finally:
         if cur:
             cur.close()
@@ -278,21 +1718,22 @@ def delete_node(node_name):
 @app.route("/api/node_class")
 @app.route("/api/classes")
 @app.route("/api/class")
+@admit('read')
 def list_node_classes():
     """Lists all node classes defined in Puppet Dashboard."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM node_classes ORDER BY UPPER(name)")
+        cur.execute("SELECT id, name FROM node_classes ORDER BY name")
+        links = get_links()
         data = []
         for r in cur.fetchall():
             name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_class', node_class_name=name)
-            data.append({"name": name, "url": url})
+            rec = {"name": name}
+            if links.enabled:
+                rec['url'] = links.href('get_node_class', node_class_name=name)
+            data.append(rec)
     finally:
         if cur:
             cur.close()
@@ -304,15 +1745,15 @@ def list_node_classes():
 
 @app.route("/api/node_class/<node_class_name>")
 @app.route("/api/class/<node_class_name>")
+@coalesce
+@admit('heavy')
 def get_node_class(node_class_name):
     """Returns detailed information about the specified node class."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM node_classes WHERE name = '%s' "
+        cur.execute("SELECT id, name FROM node_classes WHERE name = %s "
                     "LIMIT 1" % conn.escape(node_class_name))
         data = {}
         r = cur.fetchone()
@@ -326,12 +1767,13 @@ def get_node_class(node_class_name):
         data['nodes'] = get_nodes_for_class(node_class_id, node_class_name)
         for node_group in data['node_groups']:
             data['nodes'].extend(get_nodes_for_group(
-                node_group['id'], node_group['name']))
+                node_group.id, node_group.name))
     finally:
         if cur:
             cur.close()
         conn.close()
-    response = make_response(json.dumps(data, indent=2))
+    response = make_response(json.dumps(data, indent=2,
+                                        default=serialize))
     response.headers['Content-Type'] = 'application/json'
     return response
 
@@ -340,21 +1782,22 @@ def get_node_class(node_class_name):
 @app.route("/api/node_group")
 @app.route("/api/groups")
 @app.route("/api/group")
+@admit('read')
 def list_node_groups():
     """Lists all node groups defined in Puppet Dashboard."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM node_groups ORDER BY UPPER(name)")
+        cur.execute("SELECT id, name FROM node_groups ORDER BY name")
+        links = get_links()
         data = []
         for r in cur.fetchall():
             name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_group', node_group_name=name)
-            data.append({"name": name, "url": url})
+            rec = {"name": name}
+            if links.enabled:
+                rec['url'] = links.href('get_node_group', node_group_name=name)
+            data.append(rec)
     finally:
         if cur:
             cur.close()
@@ -366,15 +1809,15 @@ def list_node_groups():
 
 @app.route("/api/node_group/<node_group_name>")
 @app.route("/api/group/<node_group_name>")
+@coalesce
+@admit('heavy')
 def get_node_group(node_group_name):
     """Returns detailed information about the specified node group."""
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM node_groups WHERE name = '%s'" %
+        cur.execute("SELECT id, name FROM node_groups WHERE name = %s" %
                     conn.escape(node_group_name))
         data = {}
         r = cur.fetchone()
@@ -396,20 +1839,19 @@ def get_node_group(node_group_name):
                                                   node_group_name)
     for node_group in data['descendants']:
         data['nodes'].extend(
-            get_nodes_for_group(node_group['id'], node_group['name']))
+            get_nodes_for_group(node_group.id, node_group.name))
     for node_group in data['ancestors']:
         data['node_classes'].extend(
-            get_classes_for_group(node_group['id'], node_group['name']))
-    response = make_response(json.dumps(data, indent=2))
+            get_classes_for_group(node_group.id, node_group.name))
+    response = make_response(json.dumps(data, indent=2,
+                                        default=serialize))
     response.headers['Content-Type'] = 'application/json'
     return response
 
 
 def get_node_id(hostname):
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     result = None
     try:
         cur = conn.cursor()
@@ -426,9 +1868,7 @@ def get_node_id(hostname):
 
 def get_node_group_id(node_group_name):
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     result = None
     try:
         cur = conn.cursor()
@@ -444,12 +1884,10 @@ def get_node_group_id(node_group_name):
 
 
 def get_parameters_for_element(type, id, source):
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     sql = ("SELECT id, `key`, `value` FROM parameters "
-           "WHERE parameterable_type = '%s' AND parameterable_id = %d "
-           "ORDER BY UPPER(`key`), UPPER(`value`)") % (conn.escape(type), id)
+           "WHERE parameterable_type = %s AND parameterable_id = %d "
+           "ORDER BY `key`, `value`") % (conn.escape(type), id)
     cur = None
     result = {}
     try:
@@ -459,10 +1897,8 @@ def get_parameters_for_element(type, id, source):
             parameter_id = r[0]
             parameter_key = r[1]
             parameter_value = r[2]
-            result[parameter_key] = {'id': parameter_id,
-                                     'key': parameter_key,
-                                     'value': parameter_value,
-                                     'source': source}
+            result[parameter_key] = Parameter(parameter_id, parameter_key,
+                                              parameter_value, source)
     finally:
         if cur:
             cur.close()
@@ -471,34 +1907,29 @@ def get_parameters_for_element(type, id, source):
 
 
 def get_parameters_for_node(node_id, node_name):
-    source_url = "https://" + request.host + url_for('get_node',
-                                                     node_name=node_name)
-    source = {'type': 'node', 'name': node_name, 'href': source_url}
+    source = get_records().source('node', node_name)
     params = get_parameters_for_element("Node", node_id, source)
     groups = get_groups_for_node(node_id, node_name, False)
     for group in groups:
         group_params = get_parameters_for_group(
-            group['id'], group['name']).values()
+            group.id, group.name).values()
         for group_param in group_params:
-            key = group_param['key']
+            key = group_param.key
             if key not in params:
                 params[key] = group_param
     return params
 
 
 def get_parameters_for_group(node_group_id, node_group_name):
-    source_url = "https://%s%s" % (request.host, url_for(
-                 'get_node_group', node_group_name=node_group_name))
-    source = {'type': 'node_group', 'name': node_group_name, 'href':
-              source_url}
+    source = get_records().source('node_group', node_group_name)
     params = get_parameters_for_element("get_node_group",
                                         node_group_id, source)
     parents = get_ancestors_for_group(node_group_id, node_group_name, False)
     for parent in parents:
         parent_params = get_parameters_for_group(
-            parent['id'], parent['name']).values()
+            parent.id, parent.name).values()
         for parent_param in parent_params:
-            key = parent_param['key']
+            key = parent_param.key
             if key not in params:
                 params[key] = parent_param
     return params
@@ -506,26 +1937,21 @@ def get_parameters_for_group(node_group_id, node_group_name):
 
 def get_groups_for_node(node_id, node_name, recurse):
     result = []
-    source_url = "https://" + request.host + url_for('get_node',
-                                                     node_name=node_name)
+    records = get_records()
+    source = records.source('node', node_name)
     sql = ("SELECT ng.id, ng.name "
            "FROM node_group_memberships ngm, node_groups ng "
            "WHERE ng.id = ngm.node_group_id AND ngm.node_id = %d") % node_id
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             parent_group_id = r[0]
             parent_group_name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_group', node_group_name=parent_group_name)
-            result.append({'id': parent_group_id, 'name': parent_group_name,
-                           'source': {'type': 'node', 'name': node_name,
-                                      'href': source_url}, 'href': url})
+            result.append(records.record(parent_group_id, parent_group_name,
+                                         'node_group', source))
             if recurse:
                 result.extend(get_ancestors_for_group(
                     parent_group_id, parent_group_name, True))
@@ -538,26 +1964,21 @@ def get_groups_for_node(node_id, node_name, recurse):
 
 def get_classes_for_node(node_id, node_name):
     result = []
-    source_url = "https://" + request.host + url_for("get_node",
-                                                     node_name=node_name)
+    records = get_records()
+    source = records.source('node', node_name)
     sql = ("SELECT nc.id, nc.name "
            "FROM node_class_memberships ncm, node_classes nc "
            "WHERE nc.id = ncm.node_class_id AND ncm.node_id = %d") % node_id
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             node_class_id = r[0]
             node_class_name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_class', node_class_name=node_class_name)
-            result.append({'id': node_class_id, 'name': node_class_name,
-                           'source': {'type': 'node', 'name': node_name,
-                                      'href': source_url}, 'href': url})
+            result.append(records.record(node_class_id, node_class_name,
+                                         'node_class', source))
     finally:
         if cur:
             cur.close()
@@ -567,27 +1988,21 @@ def get_classes_for_node(node_id, node_name):
 
 def get_nodes_for_class(node_class_id, node_class_name):
     result = []
-    source_url = "https://%s%s" % (request.host, url_for(
-                 "get_node_class", node_class_name=node_class_name))
+    records = get_records()
+    source = records.source('node_class', node_class_name)
     sql = ("SELECT n.id, n.name FROM node_class_memberships ncm, nodes n "
            "WHERE n.id = ncm.node_id AND ncm.node_class_id = %d" %
            node_class_id)
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             node_id = r[0]
             node_name = r[1]
-            url = "https://" + request.host + url_for('get_node',
-                                                      node_name=node_name)
-            result.append({'id': node_id, 'name': node_name,
-                           'source': {'type': 'node_class',
-                                      'name': node_class_name,
-                                      'href': source_url}, 'href': url})
+            result.append(records.record(node_id, node_name,
+                                         'node', source))
     finally:
         if cur:
             cur.close()
@@ -597,28 +2012,22 @@ def get_nodes_for_class(node_class_id, node_class_name):
 
 def get_groups_for_class(node_class_id, node_class_name):
     result = []
-    source_url = "https://%s%s" % (request.host, url_for(
-                 "get_node_class", node_class_name=node_class_name))
+    records = get_records()
+    source = records.source('node_class', node_class_name)
     sql = ("SELECT ng.id, ng.name "
            "FROM node_group_class_memberships ngcm, node_groups ng "
            "WHERE ng.id = ngcm.node_group_id AND ngcm.node_class_id = %d" %
            node_class_id)
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             parent_group_id = r[0]
             parent_group_name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_group', node_group_name=parent_group_name)
-            result.append({'id': parent_group_id, 'name': parent_group_name,
-                           'source': {'type': 'node_class',
-                                      'name': node_class_name,
-                                      'href': source_url}, 'href': url})
+            result.append(records.record(parent_group_id, parent_group_name,
+                                         'node_group', source))
             result.extend(get_descendants_for_group(
                 parent_group_id, parent_group_name))
     finally:
@@ -630,27 +2039,21 @@ def get_groups_for_class(node_class_id, node_class_name):
 
 def get_nodes_for_group(node_group_id, node_group_name):
     result = []
-    source_url = "https://%s%s" % (request.host, url_for(
-                 "get_node_group", node_group_name=node_group_name))
+    records = get_records()
+    source = records.source('node_group', node_group_name)
     sql = ("SELECT n.id, n.name FROM node_group_memberships ngm, nodes n "
            "WHERE n.id = ngm.node_id AND ngm.node_group_id = %d" %
            node_group_id)
     cur = None
     try:
-        conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                               user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                               db=MYSQL_DASHBOARD_DB)
+        conn = connect(MYSQL_DASHBOARD_DB)
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             node_id = r[0]
             node_name = r[1]
-            url = "https://" + request.host + url_for('get_node',
-                                                      node_name=node_name)
-            result.append({'id': node_id, 'name': node_name,
-                           'source': {'type': 'node_group',
-                                      'name': node_group_name,
-                                      'href': source_url}, 'href': url})
+            result.append(records.record(node_id, node_name,
+                                         'node', source))
     finally:
         if cur:
             cur.close()
@@ -660,28 +2063,22 @@ def get_nodes_for_group(node_group_id, node_group_name):
 
 def get_classes_for_group(node_group_id, node_group_name):
     result = []
-    source_url = "https://%s%s" % (request.host, url_for(
-                 'get_node_group', node_group_name=node_group_name))
+    records = get_records()
+    source = records.source('node_group', node_group_name)
     sql = ("SELECT nc.id, nc.name "
            "FROM node_group_class_memberships ngcm, node_classes nc "
            "WHERE nc.id = ngcm.node_class_id AND ngcm.node_group_id = %d" %
            node_group_id)
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             node_class_id = r[0]
             node_class_name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_class', node_class_name=node_class_name)
-            result.append({'id': node_class_id, 'name': node_class_name,
-                           'source': {'type': 'node_group',
-                                      'name': node_group_name,
-                                      'href': source_url}, 'href': url})
+            result.append(records.record(node_class_id, node_class_name,
+                                         'node_class', source))
     finally:
         if cur:
             cur.close()
@@ -691,28 +2088,20 @@ def get_classes_for_group(node_group_id, node_group_name):
 
 def get_ancestors_for_group(node_group_id, node_group_name, recurse):
     result = []
-    source_url = "https://%s%s" % (request.host, url_for(
-                 'get_node_group', node_group_name=node_group_name))
+    records = get_records()
+    source = records.source('node_group', node_group_name)
     sql = ("SELECT ng.id, ng.name FROM node_group_edges nge, node_groups ng "
            "WHERE ng.id = nge.to_id AND nge.from_id = %d") % (node_group_id)
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             parent_group_id = r[0]
             parent_group_name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_group', node_group_name=parent_group_name)
-            result.append({'id': parent_group_id,
-                           'name': parent_group_name,
-                           'source': {'type': 'node_group',
-                                      'name': node_group_name,
-                                      'href': source_url},
-                           'href': url})
+            result.append(records.record(parent_group_id, parent_group_name,
+                                         'node_group', source))
             if recurse:
                 result.extend(get_ancestors_for_group(
                     parent_group_id, parent_group_name, True))
@@ -724,28 +2113,20 @@ def get_ancestors_for_group(node_group_id, node_group_name, recurse):
 
 def get_descendants_for_group(node_group_id, node_group_name):
     result = []
-    source_url = "https://%s%s" % (request.host, url_for(
-                 'get_node_group', node_group_name=node_group_name))
+    records = get_records()
+    source = records.source('node_group', node_group_name)
     sql = ("SELECT ng.id, ng.name FROM node_group_edges nge, node_groups ng "
            "WHERE ng.id = nge.from_id AND nge.to_id = %d") % node_group_id
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB)
     try:
         cur = conn.cursor()
         cur.execute(sql)
         for r in cur.fetchall():
             child_group_id = r[0]
             child_group_name = r[1]
-            url = "https://" + request.host + url_for(
-                'get_node_group', node_group_name=child_group_name)
-            result.append({'id': child_group_id,
-                           'name': child_group_name,
-                           'source': {'type': 'node_group',
-                                      'name': node_group_name,
-                                      'href': source_url},
-                           'href': url})
+            result.append(records.record(child_group_id, child_group_name,
+                                         'node_group', source))
             result.extend(get_descendants_for_group(
                 child_group_id, child_group_name))
     finally:
@@ -757,23 +2138,21 @@ def get_descendants_for_group(node_group_id, node_group_name):
 
 def next_hostname_for_node_group(node_group_name):
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
-    prev_name = None
+    # The primary is authoritative for which hostnames are already taken.
+    conn = connect(MYSQL_DASHBOARD_DB, write=True)
     try:
+        # Fetch every name with the group's prefix in one range scan of the
+        # nodes.name index, instead of checking candidates one at a time.
+        prefix = node_group_name.replace("\\", "\\\\").replace(
+            "%", "\\%").replace("_", "\\_")
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM nodes WHERE name LIKE %s" %
+                    conn.escape(prefix + "%"))
+        taken = set(r[0].lower() for r in cur.fetchall())
         for i in range(1, 1000):
-            sql = ("SELECT COUNT(*) FROM nodes WHERE name = %s "
-                   "ORDER BY name DESC LIMIT 1" %
-                   conn.escape('%s%03d.%s' % (node_group_name, i,
-                                              MAIN_DOMAIN)))
-            cur = conn.cursor()
-            cur.execute(sql)
-            r = cur.fetchone()
-            cur.close()
-            cur = None
-            if r[0] == 0:
-                return "%s%03d.%s" % (node_group_name, i, MAIN_DOMAIN)
+            hostname = "%s%03d.%s" % (node_group_name, i, MAIN_DOMAIN)
+            if hostname.lower() not in taken:
+                return hostname
     finally:
         if cur:
             cur.close()
@@ -784,14 +2163,14 @@ def next_hostname_for_node_group(node_group_name):
 
 def create_node(hostname):
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB, write=True)
     try:
         cur = conn.cursor()
         cur.execute("INSERT INTO nodes(name, created_at, updated_at, hidden) "
                     "VALUES(%s, NOW(), NOW(), 0)" % conn.escape(hostname))
         conn.commit()
+        expire_classification()
+        index_name('node', hostname)
     finally:
         if cur:
             cur.close()
@@ -802,26 +2181,218 @@ def add_node_to_group(hostname, node_group_name):
     node_id = get_node_id(hostname)
     node_group_id = get_node_group_id(node_group_name)
     cur = None
-    conn = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT,
-                           user=MYSQL_USER, passwd=MYSQL_PASSWD,
-                           db=MYSQL_DASHBOARD_DB)
+    conn = connect(MYSQL_DASHBOARD_DB, write=True)
     try:
         cur = conn.cursor()
         cur.execute("INSERT INTO node_group_memberships(node_id, "
                     "node_group_id, created_at, updated_at) VALUES(%d, %d, "
                     "NOW(), NOW())" % (node_id, node_group_id))
         conn.commit()
+        expire_classification()
     finally:
         if cur:
             cur.close()
         conn.close()
 
 
+# Indexes api.py's queries need, as (database, table, index name, columns).
+RECOMMENDED_INDEXES = [
+    (MYSQL_PUPPET_DB, 'hosts', 'index_hosts_on_name', ('name',)),
+    (MYSQL_PUPPET_DB, 'fact_names', 'index_fact_names_on_name', ('name',)),
+    (MYSQL_PUPPET_DB, 'fact_values',
+     'index_fact_values_on_host_id_fact_name_id',
+     ('host_id', 'fact_name_id')),
+    (MYSQL_PUPPET_DB, 'fact_values',
+     'index_fact_values_on_fact_name_id_host_id',
+     ('fact_name_id', 'host_id')),
+    (MYSQL_DASHBOARD_DB, 'nodes', 'index_nodes_on_name', ('name',)),
+    (MYSQL_DASHBOARD_DB, 'nodes', 'index_nodes_on_status_name',
+     ('status', 'name')),
+    (MYSQL_DASHBOARD_DB, 'node_groups', 'index_node_groups_on_name',
+     ('name',)),
+    (MYSQL_DASHBOARD_DB, 'node_classes', 'index_node_classes_on_name',
+     ('name',)),
+    (MYSQL_DASHBOARD_DB, 'parameters', 'index_parameters_on_parameterable',
+     ('parameterable_type', 'parameterable_id')),
+    (MYSQL_DASHBOARD_DB, 'node_group_edges',
+     'index_node_group_edges_on_from_id',
+     ('from_id', 'to_id')),
+    (MYSQL_DASHBOARD_DB, 'node_group_edges', 'index_node_group_edges_on_to_id',
+     ('to_id', 'from_id')),
+    (MYSQL_DASHBOARD_DB, 'node_group_memberships',
+     'index_node_group_memberships_on_node_id', ('node_id', 'node_group_id')),
+    (MYSQL_DASHBOARD_DB, 'node_group_memberships',
+     'index_node_group_memberships_on_node_group_id',
+     ('node_group_id', 'node_id')),
+    (MYSQL_DASHBOARD_DB, 'node_class_memberships',
+     'index_node_class_memberships_on_node_id', ('node_id', 'node_class_id')),
+    (MYSQL_DASHBOARD_DB, 'node_class_memberships',
+     'index_node_class_memberships_on_node_class_id',
+     ('node_class_id', 'node_id')),
+    (MYSQL_DASHBOARD_DB, 'node_group_class_memberships',
+     'index_node_group_class_memberships_on_node_group_id',
+     ('node_group_id', 'node_class_id')),
+    (MYSQL_DASHBOARD_DB, 'node_group_class_memberships',
+     'index_node_group_class_memberships_on_node_class_id',
+     ('node_class_id', 'node_group_id'))]
+
+
+# The read-only endpoints advise_schema() requests to collect the queries the
+# API issues, with the query string each needs. Endpoints that write
+# (provision_node, delete_node) must never be listed here.
+ADVISE_ENDPOINTS = [
+    ('list_nodes', ('status',), ""),
+    ('list_nodes', (), ""),
+    ('get_node', ('node_name',), ""),
+    ('get_node_fact', ('node_name', 'fact_name'), ""),
+    ('get_facts', (), "?nodes=%(node_name)s&facts=%(fact_name)s"),
+    ('get_stats', (), ""),
+    ('search', (), "?prefix=%(node_name)s"),
+    ('get_node_enc', ('node_name',), ""),
+    ('list_node_classes', (), ""),
+    ('get_node_class', ('node_class_name',), ""),
+    ('list_node_groups', (), ""),
+    ('get_node_group', ('node_group_name',), "")]
+
+
+def advise_schema(apply=False):
+    """Issues a GET to each of ADVISE_ENDPOINTS, using names taken from the
+    database, and runs EXPLAIN on each distinct SELECT that results, reporting
+    full table scans, filesorts and temporary tables. Then lists the
+    RECOMMENDED_INDEXES that are missing, and adds them if apply is True.
+    No write connection may be opened while the queries are collected, and an
+    index counts as present if an existing index on the table starts with the
+    same columns, so this is safe to run repeatedly. If the recommended name
+    is taken by an index on other columns, a numbered name is used instead."""
+    global captured_queries
+    samples = {}
+    cur = None
+    conn = connect_mysql(MYSQL_DASHBOARD_DB)
+    try:
+        cur = conn.cursor()
+        for arg, sql in [
+                ('node_name', "SELECT name FROM nodes LIMIT 1"),
+                ('status', "SELECT status FROM nodes "
+                           "WHERE status IS NOT NULL LIMIT 1"),
+                ('node_group_name', "SELECT name FROM node_groups LIMIT 1"),
+                ('node_class_name', "SELECT name FROM node_classes LIMIT 1")]:
+            cur.execute(sql)
+            r = cur.fetchone()
+            samples[arg] = r[0] if r else "none"
+    finally:
+        if cur:
+            cur.close()
+        conn.close()
+    samples['fact_name'] = SNAPSHOT_FACTS[0]
+
+    captured_queries = []
+    try:
+        client = app.test_client()
+        quoted = dict((arg, url_quote(value))
+                      for arg, value in samples.items())
+        for endpoint, args, query in ADVISE_ENDPOINTS:
+            with app.test_request_context():
+                url = url_for(endpoint, **dict(
+                    (arg, samples[arg]) for arg in args))
+            client.get(url + query % quoted).get_data()
+        queries = captured_queries
+    finally:
+        captured_queries = None
+
+    seen = set()
+    for db, sql in queries:
+        if (db, sql) in seen or not sql.lstrip().upper().startswith("SELECT"):
+            continue
+        seen.add((db, sql))
+        problems = []
+        cur = None
+        conn = connect_mysql(db)
+        try:
+            cur = conn.cursor(pymysql.cursors.DictCursor)
+            cur.execute("EXPLAIN " + sql)
+            for r in cur.fetchall():
+                extra = r.get('Extra') or ""
+                if r['type'] == 'ALL':
+                    problems.append("full scan of %s (~%s rows)" %
+                                    (r['table'], r['rows']))
+                if 'Using filesort' in extra:
+                    problems.append("filesort on %s" % r['table'])
+                if 'Using temporary' in extra:
+                    problems.append("temporary table for %s" % r['table'])
+        finally:
+            if cur:
+                cur.close()
+            conn.close()
+        print("%s: %s" % (db, sql))
+        for problem in problems or ["ok"]:
+            print("    %s" % problem)
+
+    print("")
+    for db, table, index_name, columns in RECOMMENDED_INDEXES:
+        cur = None
+        conn = connect_mysql(db, write=apply)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT index_name, column_name "
+                        "FROM information_schema.statistics "
+                        "WHERE table_schema = %s AND table_name = %s "
+                        "ORDER BY index_name, seq_in_index" %
+                        (conn.escape(db), conn.escape(table)))
+            existing = {}
+            for r in cur.fetchall():
+                existing.setdefault(r[0].lower(), []).append(r[1].lower())
+            if any(tuple(c[:len(columns)]) == columns
+                   for c in existing.values()):
+                continue
+            # Another index may already have the recommended name.
+            name = index_name
+            suffix = 1
+            while name.lower() in existing:
+                suffix += 1
+                name = "%s_%d" % (index_name, suffix)
+            if name != index_name:
+                print("%s: %s.%s is on (%s), not (%s)" % (
+                    db, table, index_name,
+                    ", ".join(existing[index_name.lower()]),
+                    ", ".join(columns)))
+            sql = "ALTER TABLE %s ADD INDEX %s (%s)" % (
+                table, name, ", ".join("`%s`" % c for c in columns))
+            if apply:
+                cur.execute(sql)
+                print("%s: applied %s" % (db, sql))
+            else:
+                print("%s: missing, run %s" % (db, sql))
+        finally:
+            if cur:
+                cur.close()
+            conn.close()
+
+
+# A snapshot that can't be used (from another version of this script, or
+# damaged) is reported and ignored rather than keeping the API from starting.
+# The snapshot command doesn't load it, so that it can replace a bad one.
+if (SNAPSHOT_FILE and os.path.exists(SNAPSHOT_FILE) and
+        sys.argv[1:2] != ["snapshot"]):
+    try:
+        load_snapshot(SNAPSHOT_FILE)
+        warm_from_snapshot()
+    except (ValueError, sqlite3.Error, pymysql.err.OperationalError) as e:
+        snapshot_file = None
+        classification = None
+        name_indexes = None
+        sys.stderr.write("Not using snapshot %s: %s\n" % (SNAPSHOT_FILE, e))
+
 try:
     port = int(sys.argv[1])
 except:
     port = 9000
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "snapshot":
+        write_snapshot(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == "advise-schema":
+        advise_schema(apply="--apply" in sys.argv[2:])
+        sys.exit(0)
     app.debug = True
     app.run(host='0.0.0.0', port=port)
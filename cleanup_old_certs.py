@@ -10,10 +10,10 @@
 #
 # Copyright (C) 2011-2012, Pinterest, Inc. See LICENSE for details.
 
-import json
 import socket
 import subprocess
-import urllib2
+
+from puppet_api_client import PuppetAPIClient
 
 # Base URL to the Puppet API
 PUPPET_API_URL = "https://puppet-dashboard/api"
@@ -22,14 +22,6 @@ PUPPET_API_URL = "https://puppet-dashboard/api"
 PUPPET_HOST = "puppet.example.com"
 
 
-def download_and_decode(url):
-    """Downloads a resource from the Puppet API and decodes the JSON output
-into a Python dict."""
-    request = urllib2.Request(url)
-    response = urllib2.urlopen(request)
-    return json.loads(response.read())
-
-
 def get_certs():
     """Returns a list of all certificates known to puppetca on this server."""
     cmd = "/usr/sbin/puppetca --list --all | grep '^+ ' | cut -f 2 -d '\"'"
@@ -39,8 +31,8 @@ def get_certs():
 
 
 def main():
-    nodes = download_and_decode('%s/nodes' % PUPPET_API_URL)
-    nodes = [n['name'] for n in nodes]
+    client = PuppetAPIClient(PUPPET_API_URL)
+    nodes = set(n['name'] for n in client.iter_json('nodes'))
 
     certs = get_certs()
     certs_without_nodes = [c for c in certs if c not in nodes]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# Shared HTTP client for the Puppet API (api.py) in this Git repository, used
+# by the example clients puppet_to_hosts.py and cleanup_old_certs.py. It keeps
+# one persistent HTTP(S) connection per host and thread, asks for gzipped
+# responses, retries failed requests a bounded number of times with jittered
+# backoff, can parse large JSON arrays as they arrive, and can fetch many URLs
+# concurrently.
+#
+# Copyright (C) 2011-2012, Pinterest, Inc. See LICENSE for details.
+
+import codecs
+import httplib
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urlparse
+import zlib
+from Queue import Queue, Empty
+
+# Base URL to the Puppet API
+PUPPET_API_URL = "https://puppet-dashboard/api"
+
+# Number of times a failed request is retried, and the base delay (seconds)
+# between attempts; each retry waits twice as long as the last, +/- 50%.
+RETRIES = 3
+RETRY_DELAY = 0.5
+
+# Seconds to wait for the server to connect or send data.
+TIMEOUT = 30
+
+# Bytes read from the network at a time while streaming.
+CHUNK_SIZE = 65536
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class APIError(Exception):
+    pass
+
+
+class PuppetAPIClient(object):
+    """A client for the Puppet API. Paths are relative to base_url; full URLs
+    are accepted too. Instances may be shared between threads."""
+
+    def __init__(self, base_url=PUPPET_API_URL, retries=RETRIES,
+                 timeout=TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def url(self, path):
+        if "://" in path:
+            return path
+        return "%s/%s" % (self.base_url, path.lstrip("/"))
+
+    def connection(self, scheme, netloc):
+        """Returns this thread's persistent connection to the given host."""
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def reset(self, scheme, netloc):
+        conn = self.local.connections.pop((scheme, netloc), None)
+        if conn:
+            conn.close()
+
+    def chunks(self, path):
+        """Yields the decoded (gunzipped, UTF-8) body of the given resource a
+        chunk at a time. Failures before the body starts are retried."""
+        url = urlparse.urlsplit(self.url(path))
+        target = url.path + ("?" + url.query if url.query else "")
+        attempt = 0
+        while True:
+            try:
+                conn = self.connection(url.scheme, url.netloc)
+                conn.request("GET", target, headers={
+                    'Accept': 'application/json',
+                    'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                if response.status >= 500:
+                    response.read()
+                    raise APIError("%s returned %d" % (self.url(path),
+                                                        response.status))
+                break
+            except (APIError, socket.error, httplib.HTTPException):
+                self.reset(url.scheme, url.netloc)
+                if attempt >= self.retries:
+                    raise
+                time.sleep(RETRY_DELAY * (2 ** attempt) *
+                           random.uniform(0.5, 1.5))
+                attempt += 1
+        if response.status != 200:
+            response.read()
+            raise APIError("%s returned %d" % (self.url(path),
+                                                response.status))
+        if response.getheader('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        finished = False
+        try:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if decompressor:
+                    data = (decompressor.decompress(data) if data
+                            else decompressor.flush())
+                text = decoder.decode(data, final=not data)
+                if text:
+                    yield text
+                if not data:
+                    break
+            finished = True
+        finally:
+            # A connection whose response wasn't read to the end (because of
+            # an error, or because the caller stopped early) can't be reused.
+            if not finished:
+                self.reset(url.scheme, url.netloc)
+
+    def get(self, path):
+        """Returns the body of the given resource as a unicode string."""
+        return u"".join(self.chunks(path))
+
+    def get_json(self, path):
+        """Downloads a resource from the Puppet API and decodes the JSON output
+        into a Python object."""
+        return json.loads(self.get(path))
+
+    def iter_json(self, path):
+        """Yields the elements of a resource whose body is a JSON array, each
+        as soon as it has been received, without holding the whole response
+        in memory."""
+        decoder = json.JSONDecoder()
+        buf = u""
+        started = False
+        chunks = self.chunks(path)
+        while True:
+            chunk = next(chunks, None)
+            buf += chunk or u""
+            pos = WHITESPACE.match(buf, 0).end()
+            while pos < len(buf):
+                if not started:
+                    if buf[pos] != u"[":
+                        raise ValueError("%s is not a JSON array" % path)
+                    started = True
+                    pos = WHITESPACE.match(buf, pos + 1).end()
+                    continue
+                if buf[pos] == u"]":
+                    for chunk in chunks:
+                        pass
+                    return
+                if buf[pos] == u",":
+                    pos = WHITESPACE.match(buf, pos + 1).end()
+                    continue
+                start = pos
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if chunk is None:
+                        raise
+                    break
+                # A number cut off by the end of the buffer may have been
+                # decoded as a shorter one ("1500" of "1500.0"), so an item
+                # only counts once the delimiter after it has arrived.
+                pos = WHITESPACE.match(buf, end).end()
+                if chunk is not None and (pos == len(buf) or
+                                          buf[pos] not in u",]"):
+                    pos = start
+                    break
+                yield item
+            buf = buf[pos:]
+            if chunk is None:
+                raise ValueError("%s ended before its JSON array" % path)
+
+    def get_many(self, paths, concurrency=8):
+        """Fetches and decodes the JSON of many resources using up to
+        `concurrency` threads, each with its own persistent connection.
+        Returns a dict of path to decoded object; if any fetch fails, one of
+        the errors is raised once they have all finished."""
+        paths = list(paths)
+        queue = Queue()
+        for path in paths:
+            queue.put(path)
+        results = {}
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    path = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[path] = self.get_json(path)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(concurrency, len(paths)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
@@ -6,25 +6,17 @@
 #
 # Copyright (C) 2011-2012, Pinterest, Inc. See LICENSE for details.
 
-import json
 import socket
-import urllib2
+
+from puppet_api_client import PuppetAPIClient
 
 # Base URL to the Puppet API
 PUPPET_API_URL = "https://puppet-dashboard/api"
 
 
-def download_and_decode(url):
-    """Downloads a resource from the Puppet API and decodes the JSON output
-into a Python dict."""
-    request = urllib2.Request(url)
-    response = urllib2.urlopen(request)
-    return json.loads(response.read())
-
-
 def main():
     global options
-    nodes = download_and_decode('%s/nodes' % PUPPET_API_URL)
+    nodes = list(PuppetAPIClient(PUPPET_API_URL).iter_json('nodes'))
     local_fqdn = socket.getfqdn()
     local_ip = socket.gethostbyname(local_fqdn)
     local_hostname = local_fqdn.split('.')[0]